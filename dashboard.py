@@ -1,66 +1,85 @@
-from flask import Flask, render_template_string, jsonify
+from flask import Blueprint, Flask, current_app, request, make_response
+from jinja2 import Environment
+import hashlib
+import json
 import sqlite3
-from utils import now_iso
+import threading
+import time
+from db import JobDB, SQLITE_PRAGMAS, STATEMENT_CACHE_SIZE
+from utils import now_iso, to_json
 
 DB_FILE = "queue.db"
-app = Flask(__name__)
+# column order of the job rows handed to the template (plain tuples, no per-row dicts)
+JOB_COLUMNS = ("id", "command", "state", "attempts", "max_retries", "created_at", "updated_at")
+# built once; sqlite3's statement cache is keyed by SQL text, so fixed text reuses the prepared statement
+JOBS_SQL = f"""
+    SELECT {", ".join(JOB_COLUMNS)}
+    FROM jobs
+    ORDER BY created_at DESC LIMIT 100
+"""
+CACHE_TTL = 0.5  # seconds; concurrent polls inside this window share one fetch
+bp = Blueprint("dashboard", __name__)
+
+# per-process state, shared by every app create_app() builds in this process:
+# each gunicorn worker process has its own schema flag, connections and cache
+_SCHEMA_OK = False
+_local = threading.local()
+_cache = None
+_cache_ts = 0.0
+_cache_lock = threading.Lock()
+
+
+def get_db():
+    """
+    Return this thread's connection, opening it on first use.
+    gunicorn gthread reuses its pool threads for the life of the process, so each keeps
+    one connection; in WAL mode their reads never block each other or the workers.
+    The dev server (run(threaded=True)) starts a new thread per request, so there every
+    request opens a fresh connection and runs the PRAGMAs.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_FILE, cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        _local.conn = conn
+    return conn
+
 
 # --------------------------------------------------------------------
-# 🧩 Auto Schema Upgrade - fixes all missing columns automatically
+# 🧩 Auto Schema Upgrade - JobDB creates tables and adds missing columns
 # --------------------------------------------------------------------
 def ensure_schema():
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("PRAGMA table_info(jobs)")
-    existing = [r[1] for r in cur.fetchall()]
-
-    # Required columns for display & operations
-    required_cols = {
-        "retries": "INTEGER DEFAULT 0",
-        "last_run_at": "TEXT",
-        "created_at": "TEXT",
-        "updated_at": "TEXT",
-        "attempts": "INTEGER DEFAULT 0",
-        "state": "TEXT DEFAULT 'pending'",
-        "command": "TEXT",
-    }
-
-    for col, coltype in required_cols.items():
-        if col not in existing:
-            print(f"⚙️ Adding missing column: {col}")
-            cur.execute(f"ALTER TABLE jobs ADD COLUMN {col} {coltype}")
-
-    conn.commit()
-    conn.close()
+    """Create/upgrade the schema once per process, delegating to JobDB."""
+    global _SCHEMA_OK
+    if _SCHEMA_OK:
+        return
+    JobDB(DB_FILE).close()
+    _SCHEMA_OK = True
 
 # --------------------------------------------------------------------
 # 📊 Fetch job & metric data
 # --------------------------------------------------------------------
 def fetch_data():
-    ensure_schema()
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     cur = conn.cursor()
 
     # Fetch jobs
-    cur.execute("""
-        SELECT id, command, state, attempts, max_retries, created_at, updated_at
-        FROM jobs
-        ORDER BY created_at DESC LIMIT 100
-    """)
-    jobs = [dict(r) for r in cur.fetchall()]
+    cur.execute(JOBS_SQL)
+    jobs = cur.fetchall()
 
     # Fetch summary
     cur.execute("SELECT state, COUNT(*) AS count FROM jobs GROUP BY state")
-    summary = {row["state"]: row["count"] for row in cur.fetchall()}
+    summary = dict(cur.fetchall())
 
     # Metrics
-    cur.execute("SELECT COUNT(*) FROM job_runs WHERE success=1")
-    success = cur.fetchone()[0]
-    cur.execute("SELECT COUNT(*) FROM job_runs WHERE success=0")
-    failed = cur.fetchone()[0]
+    cur.execute("""
+        SELECT COALESCE(SUM(CASE WHEN success=1 THEN 1 ELSE 0 END), 0),
+               COALESCE(SUM(CASE WHEN success=0 THEN 1 ELSE 0 END), 0)
+        FROM job_runs
+    """)
+    success, failed = cur.fetchone()
 
-    conn.close()
     metrics = {
         "total_jobs": sum(summary.values()),
         "success_runs": success,
@@ -69,13 +88,35 @@ def fetch_data():
     }
     return jobs, summary, metrics
 
+
+def cached_data():
+    """fetch_data() behind a short TTL, plus an ETag over the job/metric content."""
+    global _cache, _cache_ts
+    with _cache_lock:
+        if _cache is None or time.monotonic() - _cache_ts >= CACHE_TTL:
+            jobs, summary, metrics = fetch_data()
+            # leave the timestamp out so unchanged data keeps the same ETag; the bodies still
+            # show it, so the ETag is sent as a weak validator
+            content = {"jobs": jobs, "summary": summary,
+                       "metrics": {k: v for k, v in metrics.items() if k != "timestamp"}}
+            etag = hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+            _cache = (jobs, summary, metrics, etag)
+            _cache_ts = time.monotonic()
+        return _cache
+
+
+def not_modified(etag):
+    """Return a 304 response if the client already has this ETag, else None."""
+    if request.if_none_match.contains_weak(etag):
+        resp = make_response("", 304)
+        resp.set_etag(etag, weak=True)
+        return resp
+    return None
+
 # --------------------------------------------------------------------
-# 🌐 Web Routes
+# 🖼️ Dashboard template (compiled once at import)
 # --------------------------------------------------------------------
-@app.route("/")
-def dashboard():
-    jobs, summary, metrics = fetch_data()
-    return render_template_string("""
+HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -117,13 +158,7 @@ def dashboard():
             </tr>
             {% for j in jobs %}
             <tr>
-                <td>{{j.id}}</td>
-                <td>{{j.command}}</td>
-                <td>{{j.state}}</td>
-                <td>{{j.attempts}}</td>
-                <td>{{j.max_retries}}</td>
-                <td>{{j.created_at}}</td>
-                <td>{{j.updated_at}}</td>
+                {% for v in j %}<td>{{v}}</td>{% endfor %}
             </tr>
             {% endfor %}
         </table>
@@ -133,19 +168,53 @@ def dashboard():
         </div>
     </body>
     </html>
-    """, jobs=jobs, summary=summary, metrics=metrics)
+"""
+# compiled once at import; autoescape matches what Flask applies to .html templates
+TEMPLATE = Environment(autoescape=True, auto_reload=False).from_string(HTML)
+
+# --------------------------------------------------------------------
+# 🌐 Web Routes
+# --------------------------------------------------------------------
+@bp.route("/")
+def dashboard():
+    jobs, summary, metrics, etag = cached_data()
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    resp = make_response(TEMPLATE.render(jobs=jobs, summary=summary, metrics=metrics))
+    resp.set_etag(etag, weak=True)
+    return resp
 
 
-@app.route("/api/jobs")
+@bp.route("/api/jobs")
 def api_jobs():
-    jobs, summary, metrics = fetch_data()
-    return jsonify({"jobs": jobs, "summary": summary, "metrics": metrics})
+    jobs, summary, metrics, etag = cached_data()
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    payload = {"jobs": [dict(zip(JOB_COLUMNS, j)) for j in jobs], "summary": summary, "metrics": metrics}
+    resp = current_app.response_class(to_json(payload), mimetype="application/json")
+    resp.set_etag(etag, weak=True)
+    return resp
 
 
 # --------------------------------------------------------------------
-# 🏁 Run Flask app
+# 🏭 App factory
 # --------------------------------------------------------------------
-if __name__ == "__main__":
+def create_app():
+    """
+    Build the dashboard app. Serve it with a threaded WSGI server, e.g.
+        gunicorn -k gthread --threads 8 -b 127.0.0.1:5000 "dashboard:create_app()"
+    """
     ensure_schema()
+    app = Flask(__name__)
+    app.register_blueprint(bp)
+    return app
+
+
+# --------------------------------------------------------------------
+# 🏁 Run Flask app (local development only; use gunicorn otherwise)
+# --------------------------------------------------------------------
+if __name__ == "__main__":
     print("✅ Dashboard running at http://127.0.0.1:5000/")
-    app.run(debug=True)
+    create_app().run(threaded=True)
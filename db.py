@@ -1,9 +1,60 @@
 import sqlite3
-from datetime import datetime
-from dataclasses import dataclass, field, asdict
+import threading
+from dataclasses import dataclass, field, fields
 from typing import Optional, List, Dict, Any
 
+from utils import now_iso
+
 DB_DEFAULT = "queue.db"
+# per-connection prepared statement cache; sized so every statement in this module stays hot
+STATEMENT_CACHE_SIZE = 256
+
+# Applied to every connection. WAL lets dashboard reads run alongside worker
+# writes; NORMAL sync is durable enough in WAL mode and avoids an fsync per commit.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=30000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+)
+
+# columns added to an existing jobs table that is missing them
+JOB_COLUMN_UPGRADES = {
+    "state": "TEXT DEFAULT 'pending'",
+    "attempts": "INTEGER DEFAULT 0",
+    "max_retries": "INTEGER DEFAULT 3",
+    "timeout": "REAL",
+    "run_at": "TEXT",
+    "output": "TEXT",
+    "last_run_at": "TEXT",
+    "created_at": "TEXT",
+    "updated_at": "TEXT",
+}
+# job_runs columns writes and metrics rely on; an older table without them is moved aside
+JOB_RUN_COLUMNS = {"job_id", "started_at", "finished_at", "success", "output"}
+
+INSERT_JOB_SQL = """
+INSERT OR REPLACE INTO jobs
+  (id, command, state, attempts, max_retries, timeout, run_at, output, last_run_at, created_at, updated_at)
+VALUES
+  (:id, :command, :state, :attempts, :max_retries, :timeout, :run_at, :output, :last_run_at, :created_at, :updated_at)
+"""
+
+CLAIM_BATCH_SQL = """
+UPDATE jobs SET state='processing', updated_at=?, attempts=attempts+1
+WHERE id IN (SELECT id FROM jobs WHERE state='pending' ORDER BY created_at ASC LIMIT ?)
+RETURNING *
+"""
+
+# update_job_state variants, indexed by (attempts given) * 2 + (output given).
+# Picking a fixed string skips building the SQL (list + join) on every call; the statement
+# cache is keyed by SQL text, so the old built strings hit it just the same.
+_UPD_STATE = "UPDATE jobs SET state = ?, updated_at = ? WHERE id = ?"
+_UPD_STATE_OUT = "UPDATE jobs SET state = ?, updated_at = ?, output = ? WHERE id = ?"
+_UPD_STATE_ATT = "UPDATE jobs SET state = ?, updated_at = ?, attempts = ? WHERE id = ?"
+_UPD_STATE_ATT_OUT = "UPDATE jobs SET state = ?, updated_at = ?, attempts = ?, output = ? WHERE id = ?"
+_UPDATE_STATE_SQL = (_UPD_STATE, _UPD_STATE_OUT, _UPD_STATE_ATT, _UPD_STATE_ATT_OUT)
 
 
 def dict_factory(cursor, row):
@@ -13,11 +64,7 @@ def dict_factory(cursor, row):
     return d
 
 
-def now_iso():
-    return datetime.utcnow().isoformat()
-
-
-@dataclass
+@dataclass(slots=True)
 class Job:
     id: str
     command: str
@@ -34,8 +81,7 @@ class Job:
     @classmethod
     def from_dict(cls, data: Dict[str, Any]):
         # Filter to allowed fields to avoid TypeError
-        allowed = {f.name for f in cls.__dataclass_fields__.values()}
-        filtered = {k: v for k, v in data.items() if k in allowed}
+        filtered = {k: v for k, v in data.items() if k in _JOB_FIELDS}
         # Provide defaults for missing fields if needed
         if "created_at" not in filtered:
             filtered["created_at"] = now_iso()
@@ -44,23 +90,64 @@ class Job:
         return cls(**filtered)
 
     def to_dict(self) -> Dict[str, Any]:
-        return asdict(self)
+        # spelled out rather than asdict(), which deep-copies via reflection
+        return {
+            "id": self.id,
+            "command": self.command,
+            "state": self.state,
+            "attempts": self.attempts,
+            "max_retries": self.max_retries,
+            "timeout": self.timeout,
+            "run_at": self.run_at,
+            "output": self.output,
+            "last_run_at": self.last_run_at,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+
+_JOB_FIELDS = frozenset(f.name for f in fields(Job))
 
 
 class JobDB:
-    def __init__(self, path: str = DB_DEFAULT):
+    def __init__(self, path: str = DB_DEFAULT, new_job_event: Optional[threading.Event] = None):
         self.path = path
+        # set whenever a job becomes pending through this process; workers wait on it
+        self._new_job_event = new_job_event or threading.Event()
+        # one connection per thread, opened lazily and reused across calls
+        self._tls = threading.local()
+        self._all_conns: List[sqlite3.Connection] = []
+        self._conns_lock = threading.Lock()
         self._ensure_schema()
 
-    def _connect(self):
-        conn = sqlite3.connect(self.path, check_same_thread=False)
-        conn.row_factory = dict_factory
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._tls, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False,
+                                   cached_statements=STATEMENT_CACHE_SIZE)
+            conn.row_factory = dict_factory
+            for pragma in SQLITE_PRAGMAS:
+                conn.execute(pragma)
+            self._tls.conn = conn
+            with self._conns_lock:
+                self._all_conns.append(conn)
         return conn
 
+    def close(self):
+        """Close every connection opened by this JobDB, across all threads."""
+        with self._conns_lock:
+            conns, self._all_conns = self._all_conns, []
+        for conn in conns:
+            conn.close()
+        self._tls = threading.local()
+
     def _ensure_schema(self):
-        conn = self._connect()
+        conn = self._conn()
         cur = conn.cursor()
 
+        # journal_mode is persistent in the db file, so set it once up front
+        cur.execute("PRAGMA journal_mode=WAL")
+
         # jobs table
         cur.execute("""
         CREATE TABLE IF NOT EXISTS jobs (
@@ -78,6 +165,24 @@ class JobDB:
         );
         """)
 
+        # older databases may predate some columns; add whatever is missing
+        cur.execute("PRAGMA table_info(jobs)")
+        existing = {r["name"] for r in cur.fetchall()}
+        for col, coltype in JOB_COLUMN_UPGRADES.items():
+            if col not in existing:
+                cur.execute(f"ALTER TABLE jobs ADD COLUMN {col} {coltype}")
+
+        # job_runs from an older schema (start_at/exit_code/attempt NOT NULL ...) can't take
+        # our inserts, and columns can't be re-typed; keep its rows under another name
+        cur.execute("PRAGMA table_info(job_runs)")
+        existing = {r["name"] for r in cur.fetchall()}
+        if existing and not JOB_RUN_COLUMNS <= existing:
+            legacy, n = "job_runs_legacy", 1
+            while cur.execute("SELECT 1 FROM sqlite_master WHERE name=?", (legacy,)).fetchone():
+                n += 1
+                legacy = f"job_runs_legacy{n}"
+            cur.execute(f"ALTER TABLE job_runs RENAME TO {legacy}")
+
         # job_runs for logging each run (optional/used by metrics)
         cur.execute("""
         CREATE TABLE IF NOT EXISTS job_runs (
@@ -90,6 +195,10 @@ class JobDB:
         );
         """)
 
+        # indexes for the pending-claim / list-by-state scans and success counts
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_jobs_state_created ON jobs(state, created_at)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_job_runs_success ON job_runs(success)")
+
         # config table
         cur.execute("""
         CREATE TABLE IF NOT EXISTS config (
@@ -99,158 +208,151 @@ class JobDB:
         """)
 
         conn.commit()
-        conn.close()
 
     # ---------------- basic job ops ----------------
     def insert_job(self, job: Job):
-        conn = self._connect()
-        cur = conn.cursor()
-        cur.execute("""
-        INSERT OR REPLACE INTO jobs
-          (id, command, state, attempts, max_retries, timeout, run_at, output, last_run_at, created_at, updated_at)
-        VALUES
-          (:id, :command, :state, :attempts, :max_retries, :timeout, :run_at, :output, :last_run_at, :created_at, :updated_at)
-        """, job.to_dict())
-        conn.commit()
-        conn.close()
+        with self._conn() as conn:
+            conn.execute(INSERT_JOB_SQL, job.to_dict())
+        self._new_job_event.set()
+
+    def insert_jobs(self, jobs: List[Job]):
+        """Insert many jobs in a single transaction (one commit for the whole batch)."""
+        if not jobs:
+            return
+        with self._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(INSERT_JOB_SQL, [j.to_dict() for j in jobs])
+        self._new_job_event.set()
 
     def list_jobs(self, state: Optional[str] = None, limit: int = 100) -> List[Job]:
-        conn = self._connect()
-        cur = conn.cursor()
+        return [Job.from_dict(r) for r in self.list_jobs_raw(state=state, limit=limit)]
+
+    def list_jobs_raw(self, state: Optional[str] = None, limit: int = 100) -> List[Dict[str, Any]]:
+        """Like list_jobs but returns the row dicts as-is, for display/JSON paths."""
+        cur = self._conn().cursor()
         if state:
             cur.execute("SELECT * FROM jobs WHERE state=? ORDER BY created_at DESC LIMIT ?", (state, limit))
         else:
             cur.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,))
-        rows = cur.fetchall()
-        conn.close()
-        return [Job.from_dict(r) for r in rows]
+        return cur.fetchall()
 
-    def fetch_pending_job_for_update(self) -> Optional[Job]:
+    def claim_next_pending(self) -> Optional[Job]:
+        """Atomically pick the oldest pending job, mark it processing and count the attempt."""
+        jobs = self.claim_batch(1)
+        return jobs[0] if jobs else None
+
+    def claim_batch(self, n: int) -> List[Job]:
         """
-        Try to atomically pick a pending job and mark it processing.
-        Uses a simple UPDATE ... WHERE state='pending' ... and returns that job.
-        This reduces duplicate selection (best-effort locking).
+        Atomically claim up to n of the oldest pending jobs in one transaction.
+        BEGIN IMMEDIATE takes the write lock up front so concurrent workers
+        queue on busy_timeout instead of racing for the same rows.
         """
-        conn = self._connect()
-        cur = conn.cursor()
-        # Pick one pending job (oldest)
-        cur.execute("SELECT id FROM jobs WHERE state='pending' ORDER BY created_at ASC LIMIT 1")
-        row = cur.fetchone()
-        if not row:
-            conn.close()
-            return None
-        job_id = row["id"]
-        # Update to processing and set updated_at
-        cur.execute("UPDATE jobs SET state='processing', updated_at=? WHERE id=? AND state='pending'", (now_iso(), job_id))
-        conn.commit()
-        # Return job
-        cur.execute("SELECT * FROM jobs WHERE id=?", (job_id,))
-        job_row = cur.fetchone()
-        conn.close()
-        if not job_row:
-            return None
-        return Job.from_dict(job_row)
+        with self._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(CLAIM_BATCH_SQL, (now_iso(), n)).fetchall()
+        # RETURNING order is unspecified; run oldest first
+        rows.sort(key=lambda r: r["created_at"] or "")
+        return [Job.from_dict(r) for r in rows]
+
+    def release_jobs(self, job_ids: List[str]):
+        """Hand claimed-but-unstarted jobs back to pending, undoing their attempt count."""
+        if not job_ids:
+            return
+        with self._conn() as conn:
+            conn.executemany("""
+            UPDATE jobs SET state='pending', attempts=attempts-1, updated_at=?
+            WHERE id=? AND state='processing'
+            """, [(now_iso(), job_id) for job_id in job_ids])
+        self._new_job_event.set()
 
     def update_job_state(self, job_id: str, new_state: str, attempts: Optional[int] = None, output: Optional[str] = None):
-        conn = self._connect()
-        cur = conn.cursor()
-        fields = ["state = ?", "updated_at = ?"]
         vals = [new_state, now_iso()]
         if attempts is not None:
-            fields.append("attempts = ?")
             vals.append(attempts)
         if output is not None:
-            fields.append("output = ?")
             vals.append(output)
         vals.append(job_id)
-        cur.execute(f"UPDATE jobs SET {', '.join(fields)} WHERE id = ?", vals)
-        conn.commit()
-        conn.close()
+        sql = _UPDATE_STATE_SQL[(attempts is not None) * 2 + (output is not None)]
+        with self._conn() as conn:
+            conn.execute(sql, vals)
 
     def record_job_run(self, job_id: str, started_at: str, finished_at: str, success: int, output: Optional[str]):
-        conn = self._connect()
-        cur = conn.cursor()
-        cur.execute("INSERT INTO job_runs (job_id, started_at, finished_at, success, output) VALUES (?, ?, ?, ?, ?)",
-                    (job_id, started_at, finished_at, success, output))
-        # update last_run_at for job
-        cur.execute("UPDATE jobs SET last_run_at=?, updated_at=? WHERE id=?", (finished_at, now_iso(), job_id))
-        conn.commit()
-        conn.close()
+        with self._conn() as conn:
+            conn.execute("INSERT INTO job_runs (job_id, started_at, finished_at, success, output) VALUES (?, ?, ?, ?, ?)",
+                         (job_id, started_at, finished_at, success, output))
+            # update last_run_at for job
+            conn.execute("UPDATE jobs SET last_run_at=?, updated_at=? WHERE id=?", (finished_at, now_iso(), job_id))
+
+    def record_job_runs(self, runs: List[Dict[str, Any]]):
+        """
+        Log several finished runs and move each job to its new state in one transaction.
+        Each run is a dict with job_id, started_at, finished_at, success, output and state.
+        """
+        if not runs:
+            return
+        updated_at = now_iso()
+        with self._conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("""
+            INSERT INTO job_runs (job_id, started_at, finished_at, success, output)
+            VALUES (:job_id, :started_at, :finished_at, :success, :output)
+            """, runs)
+            conn.executemany("UPDATE jobs SET state=?, last_run_at=?, updated_at=? WHERE id=?",
+                             [(r["state"], r["finished_at"], updated_at, r["job_id"]) for r in runs])
 
     def retry_dead_job(self, job_id: str) -> bool:
-        conn = self._connect()
-        cur = conn.cursor()
-        cur.execute("SELECT id FROM jobs WHERE id=? AND state='dead'", (job_id,))
-        ok = cur.fetchone()
-        if not ok:
-            conn.close()
-            return False
-        cur.execute("UPDATE jobs SET state='pending', attempts=0, updated_at=? WHERE id=?", (now_iso(), job_id))
-        conn.commit()
-        conn.close()
-        return True
+        with self._conn() as conn:
+            cur = conn.execute("UPDATE jobs SET state='pending', attempts=0, updated_at=? WHERE id=? AND state='dead'",
+                               (now_iso(), job_id))
+        if cur.rowcount > 0:
+            self._new_job_event.set()
+            return True
+        return False
+
+    def data_version(self) -> int:
+        """Counter that changes whenever another connection commits to the db."""
+        return self._conn().execute("PRAGMA data_version").fetchone()["data_version"]
 
     # ---------------- config ----------------
     def set_config(self, key: str, value: str):
-        conn = self._connect()
-        cur = conn.cursor()
-        cur.execute("REPLACE INTO config (key, value) VALUES (?, ?)", (key, str(value)))
-        conn.commit()
-        conn.close()
+        with self._conn() as conn:
+            conn.execute("REPLACE INTO config (key, value) VALUES (?, ?)", (key, str(value)))
 
     def get_config(self, key: str) -> Optional[str]:
-        conn = self._connect()
-        cur = conn.cursor()
-        cur.execute("SELECT value FROM config WHERE key=?", (key,))
-        r = cur.fetchone()
-        conn.close()
+        r = self._conn().execute("SELECT value FROM config WHERE key=?", (key,)).fetchone()
         return r["value"] if r else None
 
+    # ---------------- maintenance ----------------
+    def optimize(self):
+        """Run PRAGMA optimize so the query planner stats stay fresh."""
+        self._conn().execute("PRAGMA optimize")
+
     # ---------------- metrics / helpers ----------------
     def counts_by_state(self) -> Dict[str, int]:
-        conn = self._connect()
-        cur = conn.cursor()
-        cur.execute("SELECT state, COUNT(*) AS cnt FROM jobs GROUP BY state")
-        rows = cur.fetchall()
-        conn.close()
+        rows = self._conn().execute("SELECT state, COUNT(*) AS cnt FROM jobs GROUP BY state").fetchall()
         return {r["state"]: r["cnt"] for r in rows}
 
     def list_job_runs(self, job_id: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
-        conn = self._connect()
-        cur = conn.cursor()
+        cur = self._conn().cursor()
         if job_id:
             cur.execute("SELECT * FROM job_runs WHERE job_id=? ORDER BY started_at DESC LIMIT ?", (job_id, limit))
         else:
             cur.execute("SELECT * FROM job_runs ORDER BY started_at DESC LIMIT ?", (limit,))
-        rows = cur.fetchall()
-        conn.close()
-        return rows
+        return cur.fetchall()
 
     def get_metrics_summary(self, recent_runs: int = 50) -> Dict[str, Any]:
-        conn = self._connect()
-        cur = conn.cursor()
-        cur.execute("SELECT COUNT(*) AS total_jobs FROM jobs")
-        total_jobs = cur.fetchone()["total_jobs"]
-        cur.execute("SELECT COUNT(*) AS success FROM job_runs WHERE success=1")
-        success_runs = cur.fetchone()["success"]
-        cur.execute("SELECT COUNT(*) AS failed FROM job_runs WHERE success=0")
-        failed_runs = cur.fetchone()["failed"]
-        conn.close()
-        avg_attempts = None
-        # compute avg attempts safely
-        try:
-            conn = self._connect()
-            cur = conn.cursor()
-            cur.execute("SELECT AVG(attempts) as avg_att FROM jobs")
-            v = cur.fetchone()
-            avg_attempts = v["avg_att"] if v else None
-            conn.close()
-        except Exception:
-            avg_attempts = None
+        # one round trip: job totals and run outcomes via conditional aggregation
+        r = self._conn().execute("""
+        SELECT j.total_jobs, j.avg_att, r.success, r.failed
+        FROM (SELECT COUNT(*) AS total_jobs, AVG(attempts) AS avg_att FROM jobs) AS j,
+             (SELECT COALESCE(SUM(CASE WHEN success=1 THEN 1 ELSE 0 END), 0) AS success,
+                     COALESCE(SUM(CASE WHEN success=0 THEN 1 ELSE 0 END), 0) AS failed
+              FROM job_runs) AS r
+        """).fetchone()
 
         return {
-            "total_jobs": total_jobs,
-            "success_runs": success_runs,
-            "failed_runs": failed_runs,
-            "avg_attempts_per_job": avg_attempts
+            "total_jobs": r["total_jobs"],
+            "success_runs": r["success"],
+            "failed_runs": r["failed"],
+            "avg_attempts_per_job": r["avg_att"]
         }
@@ -9,7 +9,7 @@ from datetime import datetime
 import click
 
 from db import Job, JobDB, now_iso
-from utils import new_id, parse_iso
+from utils import new_id, parse_iso, to_json
 
 DB_PATH = "queue.db"
 DEFAULT_CONFIG = {"max_retries": 3, "base_backoff": 2}
@@ -21,25 +21,10 @@ def cli():
 
 
 # ---------------- ENQUEUE ----------------
-@cli.command(help="Enqueue a job. Pass a JSON string or use --file <path>")
-@click.argument("job_json", required=False)
-@click.option("--file", "-f", type=click.Path(exists=True), help="JSON file containing job object")
-def enqueue(job_json, file):
-    db = JobDB(DB_PATH)
-    raw = None
-    if file:
-        with open(file, "r") as fh:
-            raw = fh.read()
-    elif job_json:
-        raw = job_json
-    else:
-        click.echo("Provide job JSON as argument or use --file")
-        sys.exit(2)
-
-    try:
-        payload = json.loads(raw)
-    except Exception as e:
-        click.echo(f"Invalid JSON: {e}")
+def build_job(db, payload):
+    """Validate a job payload, fill in defaults and return a Job (exits on bad input)."""
+    if not isinstance(payload, dict):
+        click.echo("Each job must be a JSON object")
         sys.exit(2)
 
     # defaults
@@ -61,7 +46,38 @@ def enqueue(job_json, file):
             click.echo(f"Invalid run_at format: {e}")
             sys.exit(2)
 
-    job = Job.from_dict(payload)
+    return Job.from_dict(payload)
+
+
+@cli.command(help="Enqueue a job. Pass a JSON string or use --file <path> (a JSON array enqueues many jobs)")
+@click.argument("job_json", required=False)
+@click.option("--file", "-f", type=click.Path(exists=True), help="JSON file containing a job object or an array of them")
+def enqueue(job_json, file):
+    db = JobDB(DB_PATH)
+    raw = None
+    if file:
+        with open(file, "r") as fh:
+            raw = fh.read()
+    elif job_json:
+        raw = job_json
+    else:
+        click.echo("Provide job JSON as argument or use --file")
+        sys.exit(2)
+
+    try:
+        payload = json.loads(raw)
+    except Exception as e:
+        click.echo(f"Invalid JSON: {e}")
+        sys.exit(2)
+
+    if isinstance(payload, list):
+        # batch insert: one transaction for the whole file
+        jobs = [build_job(db, p) for p in payload]
+        db.insert_jobs(jobs)
+        click.echo(f"✅ Enqueued {len(jobs)} jobs")
+        return
+
+    job = build_job(db, payload)
     db.insert_job(job)
     click.echo(f"✅ Enqueued job {job.id}")
 
@@ -72,7 +88,7 @@ def worker():
     pass
 
 
-@worker.command("start", help="Start worker(s) (spawns threads managed in worker.py)")
+@worker.command("start", help="Start worker(s) (run concurrently by the dispatcher in worker.py)")
 @click.option("--count", "-c", default=1, help="Number of workers")
 @click.option("--poll-interval", default=1.0, help="Poll interval seconds")
 def worker_start(count, poll_interval):
@@ -112,9 +128,8 @@ def status():
 @click.option("--limit", default=100)
 def list_cmd(state, limit):
     db = JobDB(DB_PATH)
-    jobs = db.list_jobs(state=state, limit=limit)
-    for j in jobs:
-        click.echo(json.dumps(j.to_dict(), default=str))
+    for r in db.list_jobs_raw(state=state, limit=limit):
+        click.echo(to_json(r))
 
 
 # ---------------- DLQ ----------------
@@ -127,9 +142,8 @@ def dlq():
 @click.option("--limit", default=100)
 def dlq_list(limit):
     db = JobDB(DB_PATH)
-    jobs = db.list_jobs(state="dead", limit=limit)
-    for j in jobs:
-        click.echo(json.dumps(j.to_dict(), default=str))
+    for r in db.list_jobs_raw(state="dead", limit=limit):
+        click.echo(to_json(r))
 
 
 @dlq.command("retry", help="Retry a job from DLQ (move to pending)")
@@ -182,7 +196,7 @@ def runs_list(job_id, limit):
     db = JobDB(DB_PATH)
     rows = db.list_job_runs(job_id=job_id, limit=limit)
     for r in rows:
-        click.echo(json.dumps(r, default=str))
+        click.echo(to_json(r))
 
 
 # ---------------- METRICS ----------------
@@ -196,7 +210,7 @@ def metrics():
 def metrics_show(recent):
     db = JobDB(DB_PATH)
     m = db.get_metrics_summary(recent_runs=recent)
-    click.echo(json.dumps(m, indent=2, default=str))
+    click.echo(to_json(m, indent=True))
 
 
 if __name__ == "__main__":
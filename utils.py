@@ -1,11 +1,39 @@
-import uuid
+import json
+import secrets
+import time
 from datetime import datetime
 
+try:
+    import orjson  # optional, C-accelerated JSON encoding
+except ImportError:
+    orjson = None
+
+# (unix second, "YYYY-MM-DDTHH:MM:SS") for the last second we formatted
+_last_second = (0, "")
+
+
 def now_iso():
-    return datetime.utcnow().isoformat()
+    """UTC timestamp with microseconds; the date/time prefix is reused within a second."""
+    global _last_second
+    sec, ns = divmod(time.time_ns(), 1_000_000_000)
+    cached_sec, prefix = _last_second
+    if sec != cached_sec:
+        prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec))
+        _last_second = (sec, prefix)
+    return f"{prefix}.{ns // 1000:06d}"
 
 def new_id():
-    return str(uuid.uuid4())[:8]
+    # 8 hex chars, same shape as the old uuid4()[:8] ids
+    return secrets.token_hex(4)
 
 def parse_iso(ts):
     return datetime.fromisoformat(ts.replace("Z", "+00:00"))
+
+def to_json(obj, indent=False):
+    """Serialize to a JSON string (orjson if installed, stdlib json otherwise); unknown types fall back to str()."""
+    if orjson is not None:
+        option = orjson.OPT_NAIVE_UTC | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, default=str, option=option).decode()
+    # same bytes as orjson: compact separators (", " / ": " only when indenting) and raw UTF-8
+    return json.dumps(obj, indent=2 if indent else None, separators=(",", ": " if indent else ":"),
+                      ensure_ascii=False, default=str)
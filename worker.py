@@ -1,103 +1,339 @@
 import os
+import re
+import shlex
 import time
+import selectors
+import sqlite3
 import subprocess
-from datetime import datetime
-from threading import Thread, Event
+from threading import Event
 from db import JobDB
 from utils import now_iso
 
 
-class Worker(Thread):
-    def __init__(self, db_path, poll_interval=1.0):
-        super().__init__()
-        self.db = JobDB(db_path)
-        self.poll_interval = poll_interval
-        self.running = True
+IDLE_BACKOFF_START = 0.05
+MAX_OUTPUT_BYTES = 64 * 1024
+READ_CHUNK = 8192
+EXIT_GRACE = 0.05
+SHUTDOWN_FLUSH_RETRIES = 3
 
-    def run(self):
-        while self.running:
-            jobs = self.db.list_jobs(state="pending", limit=1)
-            if not jobs:
-                time.sleep(self.poll_interval)
-                continue
+# anything here means the command needs a real shell to interpret it
+SHELL_META = re.compile(r"[|&;<>()$`\\*?\[\]{}~#!\n]")
+# POSIX special and regular builtins (plus common bash ones); these only exist inside a shell
+SHELL_BUILTINS = {
+    # special builtins
+    "break", ":", ".", "continue", "eval", "exec", "exit", "export", "readonly",
+    "return", "set", "shift", "times", "trap", "unset",
+    # regular builtins
+    "alias", "bg", "cd", "command", "false", "fc", "fg", "getopts", "hash", "jobs",
+    "kill", "newgrp", "pwd", "read", "true", "type", "ulimit", "umask", "unalias", "wait",
+    # bash/dash extras
+    "local", "source", "declare", "typeset", "let", "shopt", "builtin", "enable", "help",
+}
 
-            job = jobs[0]
-            print(f"⚙️ Worker picked job {job.id}: {job.command}")
-            self.db.update_job_state(job.id, "processing")
-            start_time = now_iso()
-            success = False
-            output = ""
 
-            try:
-                result = subprocess.run(
-                    job.command,
-                    shell=True,
-                    capture_output=True,
-                    text=True,
-                    timeout=job.timeout or 60,
-                )
-                output = result.stdout + result.stderr
-                success = result.returncode == 0
-            except Exception as e:
-                output = str(e)
-
-            self.db.record_job_run(job.id, start_time, now_iso(), int(success), output)
-            new_state = "completed" if success else "failed"
-
-            if not success:
-                job.attempts += 1
-                if job.attempts >= job.max_retries:
-                    new_state = "dead"
-
-            self.db.update_job_state(job.id, new_state)
-
-        print("🛑 Worker stopped gracefully.")
+def command_args(command):
+    """Split a plain command into argv, or return None if it has to go through the shell."""
+    if SHELL_META.search(command):
+        return None
+    try:
+        args = shlex.split(command)
+    except ValueError:
+        return None
+    if not args or "=" in args[0] or args[0] in SHELL_BUILTINS:
+        return None
+    return args
 
-    def stop(self):
-        self.running = False
+
+class RunningJob:
+    """
+    A claimed job whose process is running under the WorkerManager.
+    stdout and stderr are merged and only the first MAX_OUTPUT_BYTES are kept;
+    the rest is still drained so a chatty job can't block on a full pipe.
+    """
+
+    __slots__ = ("job", "proc", "started_at", "timeout", "deadline", "chunks", "total", "reading",
+                 "pidfd")
+
+    def __init__(self, job, proc):
+        self.job = job
+        self.proc = proc
+        self.started_at = now_iso()
+        self.timeout = job.timeout or 60
+        self.deadline = time.monotonic() + self.timeout
+        self.chunks = []
+        self.total = 0
+        self.reading = True
+        self.pidfd = None
+
+    def feed(self, chunk):
+        room = MAX_OUTPUT_BYTES - self.total
+        if room > 0:
+            self.chunks.append(chunk[:room])
+        self.total += len(chunk)
+
+    def output(self):
+        out = b"".join(self.chunks).decode(errors="replace")
+        if self.total > MAX_OUTPUT_BYTES:
+            out += f"\n... [output truncated, {self.total} bytes total]"
+        return out
 
 
 class WorkerManager:
+    """
+    Runs up to worker_count jobs at once from a single dispatcher thread.
+    Job processes are started with Popen and their output pipes are multiplexed
+    with a selector, so there is one SQLite connection and one writer no matter
+    how many jobs are in flight. Results that finish in the same pass share a commit.
+    """
+
     def __init__(self, db_path, worker_count=1, poll_interval=1.0):
         self.db_path = db_path
         self.worker_count = worker_count
         self.poll_interval = poll_interval
-        self.workers = []
         self.stop_event = Event()
-
-    def poll_jobs(self):
-        """Continuously runs workers that pick up jobs."""
-        # Remove any stopped workers
-        self.workers = [w for w in self.workers if w.is_alive()]
-
-        # Start new workers if needed
-        while len(self.workers) < self.worker_count and not self.stop_event.is_set():
-            w = Worker(self.db_path, poll_interval=self.poll_interval)
-            w.daemon = True
-            w.start()
-            self.workers.append(w)
-            print(f"🚀 Started worker thread ({len(self.workers)}/{self.worker_count})")
-
-        # Wait a bit before next poll
-        time.sleep(self.poll_interval)
+        self.new_job_event = Event()
+        self.db = None
+        self.selector = None
+        self.running = []
+        self.finished = []
 
     def start(self):
         print(f"👷 Starting {self.worker_count} worker(s)... Press Ctrl+C to stop.")
+        self.optimize()
         try:
-            while not self.stop_event.is_set():
-                self.poll_jobs()
+            self.run()
         except KeyboardInterrupt:
             print("🛑 Ctrl+C detected, stopping workers...")
-            self.stop()
-        self.stop_all()
+        finally:
+            # always reap children and record results, whatever ended the loop
+            self.stop_all()
+
+    def run(self):
+        """Dispatch loop: claim jobs into free slots, pump their output, record results."""
+        self.db = JobDB(self.db_path, new_job_event=self.new_job_event)
+        self.selector = selectors.DefaultSelector()
+        want_jobs = True
+        version = None
+        delay = IDLE_BACKOFF_START
+        next_check = 0.0
+
+        while not self.stop_event.is_set():
+            try:
+                free = self.worker_count - len(self.running)
+                if want_jobs and free > 0:
+                    # read before claiming so an enqueue racing the claim still shows up as a change
+                    version = self.db.data_version()
+                    batch = self.db.claim_batch(free)
+                    self.launch_all(batch)
+                    # a short batch means the queue is drained until something changes
+                    want_jobs = len(batch) == free
+                    delay = IDLE_BACKOFF_START
+                    next_check = time.monotonic() + delay
+
+                if len(self.running) >= self.worker_count:
+                    # every slot busy, nothing to claim: sleep until output, an exit or a deadline
+                    self.pump(self.poll_interval)
+                elif self.running:
+                    self.pump(delay)
+                else:
+                    self.new_job_event.wait(delay)
+                self.flush()
+
+                # in-process enqueues set the event; other processes bump data_version,
+                # which is only read once the queue looked empty and the backoff timer is due
+                if self.new_job_event.is_set():
+                    self.new_job_event.clear()
+                    want_jobs = True
+                elif not want_jobs and time.monotonic() >= next_check:
+                    if self.db.data_version() != version:
+                        want_jobs = True
+                    else:
+                        delay = min(delay * 2, self.poll_interval)
+                        next_check = time.monotonic() + delay
+            except sqlite3.Error as e:
+                # e.g. "database is locked": keep running jobs going and retry next pass;
+                # unflushed results stay in self.finished
+                print(f"⚠️ Database error, retrying: {e}")
+                if self.running:
+                    self.pump(self.poll_interval)
+                else:
+                    self.stop_event.wait(self.poll_interval)
+
+    def launch_all(self, batch):
+        """Start every claimed job; any that didn't get started go back to pending."""
+        try:
+            for job in batch:
+                self.launch(job)
+        finally:
+            started = {rj.job.id for rj in self.running} | {r["job_id"] for r in self.finished}
+            unstarted = [job for job in batch if job.id not in started]
+            if unstarted:
+                self.release(unstarted)
+
+    def release(self, jobs):
+        try:
+            self.db.release_jobs([job.id for job in jobs])
+        except sqlite3.Error as e:
+            print(f"⚠️ Could not return {len(jobs)} claimed job(s) to pending: {e}")
+
+    def launch(self, job):
+        print(f"⚙️ Worker picked job {job.id}: {job.command}")
+        args = command_args(job.command)
+        try:
+            try:
+                proc = self.spawn(job.command if args is None else args)
+            except OSError:
+                if args is None:
+                    raise
+                # not on PATH, no shebang (ENOEXEC), not executable...; let the shell
+                # run or report it exactly as before
+                proc = self.spawn(job.command)
+        except Exception as e:
+            self.finish(RunningJob(job, None), success=False, output=str(e))
+            return
+        rj = RunningJob(job, proc)
+        self.selector.register(proc.stdout, selectors.EVENT_READ, rj)
+        self.running.append(rj)
+
+    @staticmethod
+    def spawn(cmd):
+        """Start cmd (argv list, or a string run through /bin/sh) with stderr merged into stdout."""
+        return subprocess.Popen(
+            cmd,
+            shell=isinstance(cmd, str),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+
+    def pump(self, timeout):
+        """Read whatever output is ready, then reap exited and timed-out processes."""
+        timeout = min(timeout, min(rj.deadline for rj in self.running) - time.monotonic())
+        for key, _ in self.selector.select(max(0.0, timeout)):
+            rj = key.data
+            if key.fd == rj.pidfd:
+                # process exited; poll() below collects the status
+                self.unwatch_exit(rj)
+                continue
+            chunk = os.read(key.fd, READ_CHUNK)
+            if chunk:
+                rj.feed(chunk)
+            else:
+                self.close_pipe(rj)
+                self.watch_exit(rj)
+
+        now = time.monotonic()
+        still_running = []
+        for rj in self.running:
+            returncode = None if rj.reading or rj.pidfd is not None else rj.proc.poll()
+            if returncode is not None:
+                self.finish(rj, success=returncode == 0, output=rj.output())
+            elif now >= rj.deadline:
+                rj.proc.kill()
+                rj.proc.wait()
+                self.close_pipe(rj)
+                self.unwatch_exit(rj)
+                self.finish(rj, success=False,
+                            output=str(subprocess.TimeoutExpired(rj.proc.args, rj.timeout)))
+            else:
+                still_running.append(rj)
+        self.running = still_running
+
+    def close_pipe(self, rj):
+        if rj.reading:
+            self.selector.unregister(rj.proc.stdout)
+            rj.proc.stdout.close()
+            rj.reading = False
+
+    def watch_exit(self, rj):
+        """
+        After EOF on its output, wake the selector when the process exits instead of polling.
+        Without pidfd support we give it EXIT_GRACE to exit; otherwise poll() catches it
+        on a later pass.
+        """
+        try:
+            rj.pidfd = os.pidfd_open(rj.proc.pid)
+        except (AttributeError, OSError):
+            try:
+                rj.proc.wait(timeout=EXIT_GRACE)
+            except subprocess.TimeoutExpired:
+                pass
+            return
+        self.selector.register(rj.pidfd, selectors.EVENT_READ, rj)
+
+    def unwatch_exit(self, rj):
+        if rj.pidfd is not None:
+            self.selector.unregister(rj.pidfd)
+            os.close(rj.pidfd)
+            rj.pidfd = None
+
+    def finish(self, rj, success, output):
+        job = rj.job
+        new_state = "completed" if success else "failed"
+
+        # attempts was already incremented when the job was claimed
+        if not success:
+            if job.attempts >= job.max_retries:
+                new_state = "dead"
+
+        self.finished.append({
+            "job_id": job.id,
+            "started_at": rj.started_at,
+            "finished_at": now_iso(),
+            "success": int(success),
+            "output": output,
+            "state": new_state,
+        })
+
+    def flush(self):
+        """Commit finished results; if the commit fails they stay queued for the next flush."""
+        if self.finished:
+            self.db.record_job_runs(self.finished)
+            self.finished = []
 
     def stop(self):
         self.stop_event.set()
 
     def stop_all(self):
         print("🧹 Gracefully stopping all workers...")
-        for w in self.workers:
-            w.stop()
-        for w in self.workers:
-            w.join()
+        self.stop()
+        if self.db is not None:
+            # let in-flight jobs finish; nothing new is claimed
+            try:
+                while self.running:
+                    self.pump(self.poll_interval)
+            except KeyboardInterrupt:
+                print("🛑 Ctrl+C again, killing running jobs...")
+                self.kill_running()
+            self.flush_on_shutdown()
+            self.selector.close()
+            self.db.close()
+            self.db = None
+        self.optimize()
         print("✅ All workers stopped cleanly.")
+
+    def kill_running(self):
+        for rj in self.running:
+            rj.proc.kill()
+            rj.proc.wait()
+            self.close_pipe(rj)
+            self.unwatch_exit(rj)
+            self.finish(rj, success=False, output=rj.output() + "\n... [killed during shutdown]")
+        self.running = []
+
+    def flush_on_shutdown(self):
+        for _ in range(SHUTDOWN_FLUSH_RETRIES):
+            try:
+                self.flush()
+                return
+            except sqlite3.Error as e:
+                print(f"⚠️ Database error while saving results, retrying: {e}")
+                time.sleep(self.poll_interval)
+        print(f"❌ Could not record {len(self.finished)} result(s); those jobs stay in processing.")
+
+    def optimize(self):
+        try:
+            db = JobDB(self.db_path)
+            db.optimize()
+            db.close()
+        except sqlite3.Error as e:
+            print(f"⚠️ PRAGMA optimize skipped: {e}")